@@ -0,0 +1,138 @@
+import random
+from collections import Counter
+from typing import Optional
+
+from firebase_admin import firestore
+
+from config import db  # Importamos la conexion a Firestore desde config.py
+
+# numero de documentos en los que se reparten los contadores (evita el limite de escrituras por documento)
+NUM_FRAGMENTOS = 10
+
+# usuarios leidos por pagina al reconstruir las estadisticas
+TAMANO_PAGINA_RECONSTRUCCION = 500
+
+estadisticas_ref = db.collection("estadisticas_usuarios")
+
+
+# lo que aporta un usuario a los contadores (nada si el usuario no existe)
+def contribucion(usuario_data: Optional[dict]) -> dict:
+    if not usuario_data:
+        return {}
+
+    valores = {"total": 1, "con_foto": 1 if usuario_data.get("foto") else 0}
+    if usuario_data.get("fecha_nacimiento"):
+        valores[("por_anio", str(usuario_data["fecha_nacimiento"])[:4])] = 1
+    if usuario_data.get("email"):
+        valores[("por_dominio", str(usuario_data["email"]).split("@")[-1].lower())] = 1
+    return valores
+
+
+# diferencia entre dos estados de un usuario como incrementos para Firestore (None si no cambia nada)
+def calcular_delta(anterior: Optional[dict], nuevo: Optional[dict]) -> Optional[dict]:
+    diferencia = Counter(contribucion(nuevo))
+    diferencia.subtract(contribucion(anterior))
+    return incrementos(diferencia)
+
+
+# convertir un Counter de contadores en el diccionario de incrementos que se guarda en un fragmento
+def incrementos(diferencia: Counter) -> Optional[dict]:
+    delta = {}
+    for clave, valor in diferencia.items():
+        if not valor:
+            continue
+        if isinstance(clave, tuple):
+            grupo, nombre = clave
+            delta.setdefault(grupo, {})[nombre] = firestore.Increment(valor)
+        else:
+            delta[clave] = firestore.Increment(valor)
+    return delta or None
+
+
+# añadir al batch (o a la transaccion) la actualizacion de los contadores en un fragmento al azar
+def registrar_cambio(batch, anterior: Optional[dict], nuevo: Optional[dict]):
+    delta = calcular_delta(anterior, nuevo)
+    if delta:
+        fragmento_ref = estadisticas_ref.document(str(random.randrange(NUM_FRAGMENTOS)))
+        batch.set(fragmento_ref, delta, merge=True)
+
+
+# añadir al batch la baja de varios usuarios en una sola escritura de contadores
+def registrar_bajas(batch, usuarios: list):
+    diferencia = Counter()
+    for usuario_data in usuarios:
+        diferencia.subtract(contribucion(usuario_data))
+    delta = incrementos(diferencia)
+    if delta:
+        fragmento_ref = estadisticas_ref.document(str(random.randrange(NUM_FRAGMENTOS)))
+        batch.set(fragmento_ref, delta, merge=True)
+
+
+# sumar los fragmentos en un Counter con las mismas claves que contribucion()
+# (read_time permite leerlos tal y como estaban en un instante anterior)
+def sumar_fragmentos(read_time=None) -> Counter:
+    refs = [estadisticas_ref.document(str(i)) for i in range(NUM_FRAGMENTOS)]
+    contadores = Counter()
+
+    for fragmento in db.get_all(refs, read_time=read_time):
+        if not fragmento.exists:
+            continue
+        fragmento_data = fragmento.to_dict()
+        contadores["total"] += fragmento_data.get("total", 0)
+        contadores["con_foto"] += fragmento_data.get("con_foto", 0)
+        for grupo in ("por_anio", "por_dominio"):
+            for nombre, valor in fragmento_data.get(grupo, {}).items():
+                contadores[(grupo, nombre)] += valor
+    return contadores
+
+
+# sumar los fragmentos (NUM_FRAGMENTOS lecturas, sin importar cuantos usuarios haya)
+def leer_estadisticas() -> dict:
+    contadores = sumar_fragmentos()
+    grupos = {"por_anio": Counter(), "por_dominio": Counter()}
+    for clave, valor in contadores.items():
+        if isinstance(clave, tuple):
+            grupos[clave[0]][clave[1]] = valor
+
+    return {
+        "total": contadores["total"],
+        "con_foto": contadores["con_foto"],
+        "sin_foto": contadores["total"] - contadores["con_foto"],
+        "por_anio_nacimiento": {anio: n for anio, n in sorted(grupos["por_anio"].items()) if n},
+        "por_dominio_email": {dominio: n for dominio, n in grupos["por_dominio"].most_common() if n},
+    }
+
+
+# recalcular todos los contadores recorriendo la coleccion por paginas
+# se puede ejecutar con escrituras en marcha: la coleccion y los fragmentos se leen en el mismo instante
+# y solo se aplica la diferencia con Increment, asi que los cambios posteriores a ese instante se conservan
+def reconstruir_estadisticas() -> dict:
+    # instante de lectura de Firestore (no el reloj local) para todas las lecturas
+    instante = estadisticas_ref.document("0").get().read_time
+    totales = Counter()
+    ultimo = None
+
+    while True:
+        consulta = db.collection("usuarios").order_by("__name__").limit(TAMANO_PAGINA_RECONSTRUCCION)
+        if ultimo is not None:
+            consulta = consulta.start_after(ultimo)
+        pagina = consulta.select(["foto", "fecha_nacimiento", "email"]).get(read_time=instante)
+        if not pagina:
+            break
+        for user in pagina:
+            totales.update(contribucion(user.to_dict()))
+        ultimo = pagina[-1]
+
+    # corregir lo que los fragmentos se desviaban en ese instante con una sola escritura en el primer fragmento
+    totales.subtract(sumar_fragmentos(read_time=instante))
+    delta = incrementos(totales)
+    if delta:
+        estadisticas_ref.document("0").set(delta, merge=True)
+
+    return leer_estadisticas()
+
+
+# permite reconstruir los contadores a mano: python estadisticas.py
+if __name__ == "__main__":
+    resultado = reconstruir_estadisticas()
+    print(f"Estadisticas reconstruidas: {resultado['total']} usuarios, {resultado['con_foto']} con foto")
@@ -0,0 +1,267 @@
+import os
+import json
+import mmap
+import hashlib
+import random
+import time
+import struct
+import tempfile
+import threading
+import importlib.util
+from array import array
+from bisect import bisect_right
+from typing import List, Optional
+
+from firebase_admin import firestore
+
+from config import db  # Importamos la conexion a Firestore desde config.py
+from registro import obtener_logger
+
+log_indice = obtener_logger("indice_busqueda")
+
+# fichero con la copia compacta de los usuarios que comparten todos los workers
+RUTA_INDICE = os.getenv("INDICE_BUSQUEDA_RUTA", os.path.join(tempfile.gettempdir(), "usuarios_indice.bin"))
+
+# segundos entre comprobaciones de la version de la coleccion (0 desactiva el indice)
+INTERVALO_REFRESCO = float(os.getenv("INDICE_BUSQUEDA_INTERVALO", "5"))
+
+# si el indice no se ha refrescado en este tiempo se vuelve a leer de Firestore
+MAX_ANTIGUEDAD = max(INTERVALO_REFRESCO * 6, 30)
+
+# segundos tras los que el indice se reconstruye aunque la version no haya cambiado
+# (detecta escrituras cuyo incremento de version fallo)
+MAX_ANTIGUEDAD_RECONSTRUCCION = float(os.getenv("INDICE_BUSQUEDA_RECONSTRUCCION", "300"))
+
+MAGIA = b"USRIDX01"
+
+# columnas en las que buscan los endpoints (texto ya normalizado como en Firestore)
+COLUMNAS_BUSQUEDA = ["documento_identidad", "nombre_normalizado", "email"]
+
+# campos del usuario que se devuelven en las busquedas
+CAMPOS_REGISTRO = ["nombre", "email", "documento_identidad", "fecha_nacimiento", "foto"]
+
+# numero de documentos en los que se reparte la version (evita el limite de escrituras por documento)
+NUM_FRAGMENTOS_VERSION = 10
+
+# documento con la version antigua (sin fragmentar); se sigue sumando para que la version nunca retroceda
+version_usuarios_ref = db.collection("metadatos").document("usuarios")
+
+# fragmentos de la version de la coleccion usuarios (la version es la suma de todos)
+fragmentos_version_ref = version_usuarios_ref.collection("version")
+
+
+# incrementar la version de la coleccion despues de cada escritura en un fragmento al azar
+# (siempre despues de escribir, para que un ETag nunca apunte a datos antiguos)
+# devuelve False si no se pudo; el refrescador lo corrige en la siguiente reconstruccion periodica
+def incrementar_version_usuarios() -> bool:
+    try:
+        fragmento_ref = fragmentos_version_ref.document(str(random.randrange(NUM_FRAGMENTOS_VERSION)))
+        fragmento_ref.set({"version": firestore.Increment(1)}, merge=True)
+        return True
+    except Exception:
+        # la escritura del usuario ya esta hecha: no convertirla en un error, solo se retrasa el cambio de ETag
+        log_indice.exception("Error al incrementar la version de usuarios")
+        return False
+
+
+# leer la version actual de la coleccion (una sola RPC en lugar de recorrer todos los usuarios)
+# los fragmentos solo crecen, asi que la suma cambia con cada escritura
+def obtener_version_usuarios() -> int:
+    refs = [version_usuarios_ref] + [fragmentos_version_ref.document(str(i)) for i in range(NUM_FRAGMENTOS_VERSION)]
+    return sum(fragmento.to_dict().get("version", 0) for fragmento in db.get_all(refs) if fragmento.exists)
+
+
+# alinear una posicion a 4 bytes para poder leer los offsets como enteros sin copiarlos
+def alinear(posicion: int) -> int:
+    return (posicion + 3) & ~3
+
+
+# copia de solo lectura de los usuarios sobre un fichero mapeado en memoria
+# todos los workers mapean el mismo fichero, asi que el sistema operativo comparte las paginas
+class IndiceBusqueda:
+    def __init__(self, ruta: str):
+        with open(ruta, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.mm[: len(MAGIA)] != MAGIA:
+            raise ValueError(f"{ruta} no es un indice de usuarios")
+
+        (largo_cabecera,) = struct.unpack_from("<I", self.mm, len(MAGIA))
+        inicio_cabecera = len(MAGIA) + 4
+        cabecera = json.loads(self.mm[inicio_cabecera : inicio_cabecera + largo_cabecera])
+        inicio = alinear(inicio_cabecera + largo_cabecera)
+
+        self.version = cabecera["version"]
+        self.total = cabecera["total"]
+
+        # por columna: offsets de cada registro (relativos a los datos), inicio y fin de los datos
+        vista = memoryview(self.mm)
+        self.columnas = {}
+        for nombre, (pos_offsets, pos_datos, largo_datos) in cabecera["columnas"].items():
+            offsets = vista[inicio + pos_offsets : inicio + pos_offsets + (self.total + 1) * 4].cast("I")
+            self.columnas[nombre] = (offsets, inicio + pos_datos, inicio + pos_datos + largo_datos)
+
+    # posiciones (en orden) de los usuarios cuya columna contiene el texto
+    def buscar(self, columna: str, texto: str) -> List[int]:
+        offsets, inicio, fin = self.columnas[columna]
+        aguja = texto.encode("utf-8")
+
+        if not aguja:
+            return list(range(self.total))
+        if b"\n" in aguja:
+            return []  # los registros estan separados por saltos de linea
+
+        posiciones = []
+        pos = self.mm.find(aguja, inicio, fin)
+        while pos != -1:
+            i = bisect_right(offsets, pos - inicio) - 1
+            posiciones.append(i)
+            # saltar al siguiente registro para no repetir el mismo usuario
+            pos = self.mm.find(aguja, inicio + offsets[i + 1], fin)
+        return posiciones
+
+    # todas las posiciones en el orden de Firestore
+    def todos(self) -> List[int]:
+        return list(range(self.total))
+
+    # datos de los usuarios en las posiciones dadas
+    def registros(self, posiciones: List[int]) -> List[dict]:
+        offsets, inicio, _ = self.columnas["registro"]
+        return [json.loads(self.mm[inicio + offsets[i] : inicio + offsets[i + 1] - 1]) for i in posiciones]
+
+
+# recorrer la coleccion y escribir un indice nuevo (se sustituye de forma atomica)
+# devuelve la version y una huella de los datos para detectar cambios sin cambio de version
+def construir_indice(ruta: str = RUTA_INDICE):
+    # leer la version antes que los datos: el indice nunca es mas antiguo que su version
+    version = obtener_version_usuarios()
+
+    columnas = {nombre: [] for nombre in COLUMNAS_BUSQUEDA + ["registro"]}
+    for user in db.collection("usuarios").stream():
+        user_data = user.to_dict()
+        for nombre in COLUMNAS_BUSQUEDA:
+            columnas[nombre].append(str(user_data.get(nombre) or "").replace("\n", " "))
+        columnas["registro"].append(json.dumps({c: user_data.get(c) for c in CAMPOS_REGISTRO}, ensure_ascii=False))
+
+    total = len(columnas["registro"])
+    huella = hashlib.sha256("\n".join(columnas["registro"]).encode("utf-8")).hexdigest()
+    secciones = []
+    cabecera_columnas = {}
+    posicion = 0
+    for nombre, valores in columnas.items():
+        datos = bytearray()
+        offsets = array("I")
+        for valor in valores:
+            offsets.append(len(datos))
+            datos += valor.encode("utf-8") + b"\n"
+        offsets.append(len(datos))
+
+        pos_offsets = posicion
+        pos_datos = pos_offsets + len(offsets) * 4
+        cabecera_columnas[nombre] = [pos_offsets, pos_datos, len(datos)]
+        relleno = alinear(pos_datos + len(datos)) - (pos_datos + len(datos))
+        secciones += [offsets.tobytes(), bytes(datos), b"\0" * relleno]
+        posicion = pos_datos + len(datos) + relleno
+
+    cabecera = json.dumps({"version": version, "total": total, "columnas": cabecera_columnas}).encode("utf-8")
+    inicio_datos = len(MAGIA) + 4 + len(cabecera)
+
+    ruta_temporal = f"{ruta}.{os.getpid()}.tmp"
+    with open(ruta_temporal, "wb") as f:
+        f.write(MAGIA)
+        f.write(struct.pack("<I", len(cabecera)))
+        f.write(cabecera)
+        f.write(b"\0" * (alinear(inicio_datos) - inicio_datos))
+        for seccion in secciones:
+            f.write(seccion)
+    os.replace(ruta_temporal, ruta)
+    return version, huella
+
+
+_indice_actual = None
+_inodo_actual = None
+_lock_indice = threading.Lock()
+
+
+# devolver el indice mapeado (o None si no existe, esta desactualizado o es de otra version para volver a Firestore)
+def obtener_indice(version: int) -> Optional[IndiceBusqueda]:
+    global _indice_actual, _inodo_actual
+
+    if INTERVALO_REFRESCO <= 0:
+        return None
+
+    try:
+        estado = os.stat(RUTA_INDICE)
+    except FileNotFoundError:
+        return None
+
+    # el refrescador toca el fichero en cada comprobacion: si lleva tiempo sin hacerlo no es fiable
+    if time.time() - estado.st_mtime > MAX_ANTIGUEDAD:
+        return None
+
+    # os.replace crea un inodo nuevo en cada reconstruccion
+    if estado.st_ino != _inodo_actual:
+        with _lock_indice:
+            if estado.st_ino != _inodo_actual:
+                try:
+                    _indice_actual = IndiceBusqueda(RUTA_INDICE)
+                except (OSError, ValueError):
+                    return None
+                _inodo_actual = estado.st_ino
+
+    # un indice de otra version no refleja las ultimas escrituras (o aun no se ha reconstruido)
+    indice = _indice_actual
+    if indice is None or indice.version != version:
+        return None
+    return indice
+
+
+# bucle del refrescador: solo el proceso que tiene el lock reconstruye el indice
+def _bucle_refresco():
+    import fcntl  # solo existe en Unix; iniciar_refresco comprueba antes que este disponible
+
+    archivo_lock = open(f"{RUTA_INDICE}.lock", "w")
+    # los demas workers esperan aqui; si el refrescador muere el lock se libera y otro lo sustituye
+    fcntl.flock(archivo_lock, fcntl.LOCK_EX)
+
+    version = None
+    huella = None
+    construido_en = 0.0
+    while True:
+        try:
+            caducado = time.monotonic() - construido_en > MAX_ANTIGUEDAD_RECONSTRUCCION
+            if version is None or caducado or obtener_version_usuarios() != version or not os.path.exists(RUTA_INDICE):
+                version_nueva, huella_nueva = construir_indice()
+                construido_en = time.monotonic()
+                if version_nueva == version and huella_nueva != huella:
+                    # los datos cambiaron sin cambiar la version (fallo un incremento): subirla para
+                    # invalidar los ETags; si vuelve a fallar se reintenta en la siguiente vuelta
+                    if incrementar_version_usuarios():
+                        huella = huella_nueva
+                    else:
+                        construido_en = 0.0
+                else:
+                    huella = huella_nueva
+                version = version_nueva
+            else:
+                os.utime(RUTA_INDICE)  # marcar el indice como vigente
+        except Exception:
+            log_indice.exception("Error al refrescar el indice de busqueda")
+        time.sleep(INTERVALO_REFRESCO)
+
+
+# arrancar el refrescador en segundo plano (se llama al iniciar cada worker)
+def iniciar_refresco():
+    if INTERVALO_REFRESCO <= 0:
+        return
+    if importlib.util.find_spec("fcntl") is None:
+        # sin flock (Windows) no se puede elegir un unico refrescador: las busquedas van siempre a Firestore
+        log_indice.warning("fcntl no disponible: indice de busqueda desactivado")
+        return
+    threading.Thread(target=_bucle_refresco, name="refresco-indice", daemon=True).start()
+
+
+# permite reconstruir el indice a mano: python indice_busqueda.py
+if __name__ == "__main__":
+    version, _ = construir_indice()
+    print(f"Indice construido con la version {version} en {RUTA_INDICE}")
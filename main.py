@@ -1,22 +1,37 @@
 import os
 import json
+import asyncio
+import threading
 import base64
 import csv
+import hashlib
 from io import StringIO
+from concurrent.futures import ThreadPoolExecutor
 from fastapi import UploadFile, File, Form, HTTPException
 from fastapi import FastAPI, HTTPException, Query, Form, File, UploadFile
 from config import db  # Importamos la conexion a Firestore desde config.py
+from registro import obtener_logger
+from estadisticas import registrar_cambio, registrar_bajas, leer_estadisticas
+from indice_busqueda import obtener_indice, obtener_version_usuarios, incrementar_version_usuarios, iniciar_refresco, version_usuarios_ref
 from pydantic import BaseModel, EmailStr, field_validator
-from datetime import date, datetime
+from datetime import date, datetime, timezone
 from typing import List, Optional
+from contextlib import asynccontextmanager
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import JSONResponse
-from fastapi import Request, Body
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi import Request, Response, Body
 from fastapi.staticfiles import StaticFiles
-from firebase_admin import storage  # Solo importa storage si lo necesitas
+from firebase_admin import storage, firestore  # storage para las fotos, firestore para transacciones y marcas de tiempo
+from google.api_core.exceptions import AlreadyExists, NotFound, PreconditionFailed
 
-app = FastAPI()
+# al arrancar cada worker se lanza el refrescador del indice de busqueda (solo uno lo reconstruye)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    iniciar_refresco()
+    yield
+
+app = FastAPI(lifespan=lifespan)
 
 # habilitar cors para permitir peticiones desde el frontend
 app.add_middleware(
@@ -25,6 +40,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],  # permitir todos los métodos (GET, POST, etc.)
     allow_headers=["*"],  # permitir todos los encabezados
+    expose_headers=["ETag"],  # permitir que el frontend lea el ETag para peticiones condicionales
 )
 
 # montar el directorio 'uploads' para servir archivos estaticos
@@ -33,6 +49,13 @@ app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
 import unicodedata
 import re  # para validar el dni
 
+# expresiones regulares compiladas una sola vez
+REGEX_DOCUMENTO = re.compile(r"^[a-zA-Z0-9]{6,15}$")
+REGEX_FECHA = re.compile(r"^(\d{4})-(\d{1,2})-(\d{1,2})$")
+
+# campos obligatorios en las importaciones
+CAMPOS_REQUERIDOS = ["nombre", "email", "documento_identidad", "fecha_nacimiento"]
+
 # funcion para normalizar texto (eliminar acentos y convertir a minusculas)
 def normalizar_texto(texto: str) -> str:
     return "".join(
@@ -40,6 +63,112 @@ def normalizar_texto(texto: str) -> str:
     )
 
 
+# responder una busqueda desde el indice compartido (solo se crean los Usuario de la pagina pedida)
+def paginar_indice(indice, posiciones: List[int], skip: int, limit: int, mensaje_no_encontrado: str) -> dict:
+    if not posiciones:
+        raise HTTPException(status_code=404, detail=mensaje_no_encontrado)
+
+    usuarios = []
+    for user_data in indice.registros(posiciones[skip : skip + limit]):
+        user_data["fecha_nacimiento"] = date.fromisoformat(user_data["fecha_nacimiento"])
+        usuarios.append(Usuario(**user_data))
+
+    return {"usuarios": usuarios, "total": len(posiciones)}
+
+# añadir la marca de tiempo del servidor que usa el feed de cambios
+def con_marca_de_tiempo(datos: dict) -> dict:
+    return {**datos, "actualizado_en": firestore.SERVER_TIMESTAMP}
+
+# dejar constancia de un usuario eliminado para que el feed de cambios pueda informar de la baja
+# (batch puede ser tambien una transaccion)
+def marcar_eliminado(documento_identidad: str, batch=None):
+    datos = {"documento_identidad": documento_identidad, "eliminado_en": firestore.SERVER_TIMESTAMP}
+    eliminado_ref = db.collection("usuarios_eliminados").document(documento_identidad)
+    if batch is not None:
+        batch.set(eliminado_ref, datos)
+    else:
+        eliminado_ref.set(datos)
+
+# leer un usuario dentro de una transaccion (404 si no existe)
+def leer_usuario(transaccion, usuario_ref) -> dict:
+    usuario_doc = usuario_ref.get(transaction=transaccion)
+    if not usuario_doc.exists:
+        raise HTTPException(status_code=404, detail="Usuario no encontrado")
+    return usuario_doc.to_dict()
+
+# actualizar campos de un usuario y sus estadisticas a partir del estado leido en la misma transaccion
+# devuelve el usuario tal y como estaba antes del cambio
+@firestore.transactional
+def actualizar_usuario_transaccion(transaccion, usuario_ref, cambios: dict) -> dict:
+    usuario_actual = leer_usuario(transaccion, usuario_ref)
+    transaccion.update(usuario_ref, con_marca_de_tiempo(cambios))
+    registrar_cambio(transaccion, usuario_actual, {**usuario_actual, **cambios})
+    return usuario_actual
+
+# mover un usuario a otro documento de identidad aplicando los cambios en la misma transaccion
+@firestore.transactional
+def mover_usuario_transaccion(transaccion, usuario_ref, nuevo_usuario_ref, cambios: dict) -> dict:
+    usuario_actual = leer_usuario(transaccion, usuario_ref)
+    if nuevo_usuario_ref.get(transaction=transaccion).exists:
+        raise HTTPException(status_code=400, detail="el nuevo documento de identidad ya esta registrado")
+
+    nuevo_usuario_data = {**usuario_actual, **cambios, "documento_identidad": nuevo_usuario_ref.id}
+    transaccion.create(nuevo_usuario_ref, con_marca_de_tiempo(nuevo_usuario_data))
+    transaccion.delete(usuario_ref)
+    marcar_eliminado(usuario_ref.id, transaccion)
+    registrar_cambio(transaccion, usuario_actual, nuevo_usuario_data)
+    return usuario_actual
+
+# eliminar un usuario y descontarlo de las estadisticas en la misma transaccion
+@firestore.transactional
+def eliminar_usuario_transaccion(transaccion, usuario_ref) -> dict:
+    usuario_actual = leer_usuario(transaccion, usuario_ref)
+    transaccion.delete(usuario_ref)
+    marcar_eliminado(usuario_ref.id, transaccion)
+    registrar_cambio(transaccion, usuario_actual, None)
+    return usuario_actual
+
+# quitar la foto de un usuario y descontarla de las estadisticas; devuelve la URL que tenia
+@firestore.transactional
+def quitar_foto_transaccion(transaccion, usuario_ref) -> str:
+    usuario_actual = leer_usuario(transaccion, usuario_ref)
+    foto_actual = usuario_actual.get("foto")
+    if not foto_actual:
+        raise HTTPException(status_code=404, detail="Este usuario no tiene foto para borrar")
+    transaccion.update(usuario_ref, con_marca_de_tiempo({"foto": None}))
+    registrar_cambio(transaccion, usuario_actual, {**usuario_actual, "foto": None})
+    return foto_actual
+
+# crear un usuario nuevo junto con sus estadisticas (create falla si otra peticion lo ha creado antes)
+def crear_usuario(usuario_ref, usuario_dict: dict):
+    batch = db.batch()
+    batch.create(usuario_ref, con_marca_de_tiempo(usuario_dict))
+    registrar_cambio(batch, None, usuario_dict)
+    batch.commit()
+
+# generar un ETag fuerte a partir de las partes que identifican la respuesta
+def generar_etag(*partes) -> str:
+    return '"' + hashlib.sha256("|".join(str(p) for p in partes).encode("utf-8")).hexdigest()[:32] + '"'
+
+# ETag de un documento a partir de su update_time de Firestore
+def etag_documento(snapshot, *partes) -> str:
+    return generar_etag(snapshot.id, snapshot.update_time.isoformat(), *partes)
+
+# comprobar si el ETag coincide con la cabecera If-None-Match del cliente
+def etag_coincide(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    etags_cliente = [e.strip().removeprefix("W/") for e in if_none_match.split(",")]
+    return etag in etags_cliente
+
+# respuesta 304 sin cuerpo (no se vuelve a serializar nada)
+def respuesta_no_modificada(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag})
+
+
 # modelo de usuario con validaciones
 class Usuario(BaseModel):
     nombre: str
@@ -50,7 +179,7 @@ class Usuario(BaseModel):
 
     @field_validator("documento_identidad")
     def validar_documento_identidad(cls, documento_identidad):
-        if not re.match(r"^[a-zA-Z0-9]{6,15}$", documento_identidad):
+        if not REGEX_DOCUMENTO.match(documento_identidad):
             raise ValueError("el documento de identidad debe ser alfanumerico y tener entre 6 y 15 caracteres")
         return documento_identidad
 
@@ -90,6 +219,44 @@ class UsuarioUpdate(BaseModel):
                 raise ValueError("la fecha de nacimiento no puede ser hoy ni en el futuro")
         return fecha
 
+# modelo para consultar varios usuarios en una sola peticion
+class ConsultaLote(BaseModel):
+    documentos: List[str]
+    campos: Optional[List[str]] = None  # mascara de campos opcional (por ejemplo ["nombre", "foto"])
+
+
+# maximo de documentos por consulta en lote
+MAX_DOCUMENTOS_LOTE = 300
+
+# campos que se pueden pedir en la mascara de una consulta en lote
+CAMPOS_CONSULTABLES = {"nombre", "email", "documento_identidad", "fecha_nacimiento", "foto"}
+
+# modelo para eliminar varios usuarios en una sola peticion
+class EliminacionLote(BaseModel):
+    documentos: List[str]
+
+
+# maximo de documentos por peticion de eliminacion en lote
+MAX_DOCUMENTOS_ELIMINACION = 5000
+
+# Firestore permite como maximo 500 operaciones por batch
+TAMANO_BATCH_FIRESTORE = 500
+
+# hilos para borrar fotos de Storage en paralelo
+MAX_HILOS_BORRADO_FOTOS = 16
+
+# bucket de Firebase Storage donde se guardan las fotos
+NOMBRE_BUCKET = "pf25-carlos-db.firebasestorage.app"
+
+# las fotos se guardan con su hash SHA-256 como nombre, asi que su contenido nunca cambia
+CACHE_CONTROL_FOTOS = "public, max-age=31536000, immutable"
+
+# tamaño de los bloques leidos al calcular el hash de una foto
+TAMANO_BLOQUE_FOTO = 1024 * 1024
+
+# nombre de blob de las fotos guardadas por contenido
+REGEX_HASH_FOTO = re.compile(r"^[0-9a-f]{64}$")
+
 # el endpoint de registro
 @app.post("/usuarios", response_model=dict)
 async def registrar_usuario(usuario: Usuario):
@@ -116,19 +283,267 @@ async def registrar_usuario(usuario: Usuario):
         usuario_dict["email"] = usuario.email.lower()
         usuario_dict["documento_identidad"] = usuario.documento_identidad.upper()
 
-        # Guardar en Firestore
-        usuario_ref.set(usuario_dict)
+        # las fotos del bucket solo se pueden asignar si estan guardadas por contenido
+        error = error_foto_asignada(usuario.foto)
+        if error:
+            raise HTTPException(status_code=400, detail=error)
+
+        # la foto cuenta como una referencia mas (se suelta si no se llega a guardar)
+        adquirir_foto(usuario.foto)
+
+        # Guardar en Firestore junto con los contadores de estadisticas
+        try:
+            crear_usuario(usuario_ref, usuario_dict)
+        except AlreadyExists:
+            soltar_foto(usuario.foto)
+            raise HTTPException(status_code=400, detail="Este documento de identidad ya ha sido registrado")
+        except Exception:
+            soltar_foto(usuario.foto)
+            raise
+        incrementar_version_usuarios()
 
         return {"message": "Usuario registrado correctamente", "usuario": usuario_dict}
 
+    except HTTPException:
+        raise
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error interno del servidor: {str(e)}")
 
+# convertir el cursor recibido (fecha ISO 8601) a datetime con zona horaria
+def parsear_cursor(desde: str) -> datetime:
+    try:
+        cursor = datetime.fromisoformat(desde)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Cursor no válido. Debe ser una fecha ISO 8601")
+    if cursor.tzinfo is None:
+        cursor = cursor.replace(tzinfo=timezone.utc)
+    return cursor
+
+# leer los cambios dentro de una transaccion de solo lectura para que todas las lecturas vean el mismo instante
+# devuelve tambien el instante de lectura de Firestore, que es el siguiente cursor aunque no haya cambios
+@firestore.transactional
+def leer_cambios(transaccion, desde: Optional[datetime]):
+    # un documento leido (aunque no exista) siempre trae el read_time de Firestore, nunca el reloj del servidor
+    read_time = version_usuarios_ref.get(transaction=transaccion).read_time
+
+    if desde is None:
+        # sincronizacion inicial: todos los usuarios (incluidos los que aun no tienen actualizado_en)
+        return db.collection("usuarios").get(transaction=transaccion), [], read_time
+
+    usuarios = (
+        db.collection("usuarios")
+        .where("actualizado_en", ">", desde)
+        .order_by("actualizado_en")
+        .get(transaction=transaccion)
+    )
+    eliminados = (
+        db.collection("usuarios_eliminados")
+        .where("eliminado_en", ">", desde)
+        .get(transaction=transaccion)
+    )
+    return usuarios, eliminados, read_time
+
+# endpoint para obtener solo los usuarios que han cambiado desde un cursor
+@app.get("/usuarios/cambios", response_model=dict)
+def obtener_cambios(desde: Optional[str] = None):
+    cursor_desde = parsear_cursor(desde) if desde else None
+
+    usuarios_snapshots, eliminados_snapshots, cursor = leer_cambios(db.transaction(read_only=True), cursor_desde)
+
+    usuarios = []
+    for user in usuarios_snapshots:
+        user_data = user.to_dict()
+        user_data["fecha_nacimiento"] = date.fromisoformat(user_data["fecha_nacimiento"])
+        usuarios.append(Usuario(**user_data))
+
+    # un usuario que existe ahora no esta eliminado aunque se borrase y volviese a crear despues del cursor
+    documentos_actuales = {user.id for user in usuarios_snapshots}
+    eliminados = [e.id for e in eliminados_snapshots if e.id not in documentos_actuales]
+
+    # el siguiente cursor es el instante de lectura de Firestore
+    return {"usuarios": usuarios, "eliminados": eliminados, "cursor": cursor.isoformat()}
+
+
+# endpoint con el numero de usuarios por año de nacimiento, dominio de email y foto
+@app.get("/usuarios/estadisticas", response_model=dict)
+def obtener_estadisticas():
+    return leer_estadisticas()
+
+
+# maximo de eventos pendientes por cliente SSE antes de pedirle que vuelva a sincronizar
+MAX_EVENTOS_PENDIENTES = 100
+
+# segundos entre comentarios de keep-alive en el stream SSE
+INTERVALO_PING_SSE = 15
+
+# segundos maximos esperando el primer snapshot de un listener nuevo antes de empezar a enviar eventos
+TIEMPO_ESPERA_LISTENER = 10
+
+# tipos de cambio de Firestore traducidos a los eventos que reciben los clientes
+TIPOS_EVENTO = {"ADDED": "alta", "MODIFIED": "modificacion", "REMOVED": "baja"}
+
+# evento SSE de un usuario (sin datos si es una baja)
+def evento_usuario(tipo: str, documento_identidad: str, cursor: str, datos: Optional[dict] = None) -> dict:
+    evento = {"tipo": tipo, "documento_identidad": documento_identidad, "cursor": cursor}
+    if datos is not None:
+        evento["usuario"] = {campo: datos.get(campo) for campo in Usuario.model_fields}
+    return evento
+
+# eventos con los cambios ocurridos desde un cursor y el instante de Firestore hasta el que llegan
+def eventos_desde(desde: datetime):
+    usuarios_snapshots, eliminados_snapshots, read_time = leer_cambios(db.transaction(read_only=True), desde)
+    cursor = read_time.isoformat()
+
+    eventos = [evento_usuario("modificacion", user.id, cursor, user.to_dict()) for user in usuarios_snapshots]
+    documentos_actuales = {user.id for user in usuarios_snapshots}
+    eventos += [evento_usuario("baja", e.id, cursor) for e in eliminados_snapshots if e.id not in documentos_actuales]
+    return eventos, read_time
+
+# mensaje SSE de un evento (sin id no cambia el ultimo cursor que guarda el cliente)
+def formatear_evento(evento: dict, con_id: bool = True) -> str:
+    id_evento = f"id: {evento['cursor']}\n" if con_id else ""
+    return f"{id_evento}event: {evento['tipo']}\ndata: {json.dumps(evento)}\n\n"
+
+# reparte los cambios de un unico listener on_snapshot de Firestore entre todos los clientes SSE
+class DifusorCambios:
+    def __init__(self):
+        # protege suscriptores y loop frente al hilo de Firestore (nunca se espera a Firestore con el lock cogido)
+        self.lock = threading.Lock()
+        # serializa arrancar y parar el listener sin bloquear el event loop
+        self.lock_watch = asyncio.Lock()
+        self.suscriptores = set()
+        self.watch = None
+        self.listo = None  # se activa cuando el listener actual ha recibido su primer snapshot
+        self.loop = None
+
+    # registrar un cliente y arrancar el listener si es el primero
+    async def suscribir(self) -> asyncio.Queue:
+        cola = asyncio.Queue(maxsize=MAX_EVENTOS_PENDIENTES)
+        async with self.lock_watch:
+            with self.lock:
+                self.loop = asyncio.get_running_loop()
+                self.suscriptores.add(cola)
+            if self.watch is None:
+                # on_snapshot abre el stream y arranca hilos: se hace fuera del event loop
+                listo = threading.Event()
+                try:
+                    self.watch = await asyncio.to_thread(db.collection("usuarios").on_snapshot, self._crear_callback(listo))
+                except Exception:
+                    with self.lock:
+                        self.suscriptores.discard(cola)
+                    raise
+                self.listo = listo
+            listo = self.listo
+
+        # los cambios llegan a partir del primer snapshot: esperarlo para que una lectura posterior no deje huecos
+        if not listo.is_set():
+            await asyncio.to_thread(listo.wait, TIEMPO_ESPERA_LISTENER)
+        return cola
+
+    # quitar un cliente y parar el listener si ya no queda ninguno
+    async def cancelar(self, cola: asyncio.Queue):
+        async with self.lock_watch:
+            with self.lock:
+                self.suscriptores.discard(cola)
+                quedan_suscriptores = bool(self.suscriptores)
+            if not quedan_suscriptores and self.watch is not None:
+                watch, self.watch, self.listo = self.watch, None, None
+                # unsubscribe espera al hilo del listener (hasta 1 s): fuera del event loop y sin self.lock
+                await asyncio.to_thread(watch.unsubscribe)
+
+    # callback para un listener nuevo; cada listener descarta su propio primer snapshot
+    def _crear_callback(self, listo: threading.Event):
+        snapshot_inicial = True
+
+        def al_cambiar(snapshots, cambios, read_time):
+            nonlocal snapshot_inicial
+            # el primer snapshot trae toda la coleccion; los clientes ya la tienen por /usuarios/cambios
+            if snapshot_inicial:
+                snapshot_inicial = False
+                listo.set()
+                return
+            self._al_cambiar(cambios, read_time)
+
+        return al_cambiar
+
+    # callback de Firestore (se ejecuta en un hilo del cliente de Firestore)
+    def _al_cambiar(self, cambios, read_time):
+        with self.lock:
+            colas = list(self.suscriptores)
+            loop = self.loop
+
+        cursor = read_time.isoformat()
+        eventos = []
+        for cambio in cambios:
+            tipo = TIPOS_EVENTO.get(cambio.type.name, cambio.type.name.lower())
+            datos = cambio.document.to_dict() if cambio.type.name != "REMOVED" else None
+            eventos.append(evento_usuario(tipo, cambio.document.id, cursor, datos))
+
+        for cola in colas:
+            loop.call_soon_threadsafe(self._encolar, cola, eventos)
+
+    @staticmethod
+    def _encolar(cola: asyncio.Queue, eventos: list):
+        for evento in eventos:
+            if cola.full():
+                # cliente demasiado lento: vaciar su cola y pedirle que sincronice con /usuarios/cambios
+                while not cola.empty():
+                    cola.get_nowait()
+                cola.put_nowait({"tipo": "resincronizar", "cursor": evento["cursor"]})
+                return
+            cola.put_nowait(evento)
+
+
+difusor_cambios = DifusorCambios()
+
+# endpoint SSE con los cambios de usuarios en tiempo real
+# con Last-Event-ID (al reconectar) o desde (cursor de /usuarios/cambios) primero se envian los cambios perdidos
+@app.get("/usuarios/cambios/stream")
+async def stream_cambios(request: Request, desde: Optional[str] = None):
+    ultimo_cursor = request.headers.get("last-event-id") or desde
+    cursor_desde = parsear_cursor(ultimo_cursor) if ultimo_cursor else None
+
+    # suscribirse antes de leer los cambios pendientes para no perder los que lleguen entre medias
+    cola = await difusor_cambios.suscribir()
+
+    pendientes, leido_hasta = [], None
+    if cursor_desde is not None:
+        try:
+            pendientes, leido_hasta = await asyncio.to_thread(eventos_desde, cursor_desde)
+        except Exception:
+            await difusor_cambios.cancelar(cola)
+            raise
+
+    async def eventos():
+        try:
+            # solo el ultimo lleva id: si el cliente se corta a mitad vuelve a pedir todo el hueco
+            for i, evento in enumerate(pendientes):
+                yield formatear_evento(evento, con_id=i == len(pendientes) - 1)
+
+            while not await request.is_disconnected():
+                try:
+                    evento = await asyncio.wait_for(cola.get(), timeout=INTERVALO_PING_SSE)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"  # mantener viva la conexion
+                    continue
+                # los cambios anteriores a la lectura de pendientes ya se han enviado
+                if leido_hasta is not None and evento["tipo"] != "resincronizar" and datetime.fromisoformat(evento["cursor"]) <= leido_hasta:
+                    continue
+                yield formatear_evento(evento)
+        finally:
+            await difusor_cambios.cancelar(cola)
+
+    return StreamingResponse(
+        eventos(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 # endpoint para obtener un usuario por su documento de identidad
 @app.get("/usuarios/{documento_identidad}", response_model=Usuario)
-def obtener_usuario(documento_identidad: str):
+def obtener_usuario(documento_identidad: str, request: Request, response: Response):
     # convertir el documento de identidad recibido a mayusculas
     documento_identidad = documento_identidad.upper()
 
@@ -137,93 +552,312 @@ def obtener_usuario(documento_identidad: str):
     if not usuario_doc.exists:
         raise HTTPException(status_code=404, detail="usuario no encontrado")
 
+    # si el cliente ya tiene esta version del documento devolver 304
+    etag = etag_documento(usuario_doc)
+    if etag_coincide(request, etag):
+        return respuesta_no_modificada(etag)
+    response.headers["ETag"] = etag
+
     usuario_data = usuario_doc.to_dict()
     usuario_data["fecha_nacimiento"] = date.fromisoformat(usuario_data["fecha_nacimiento"])
     return Usuario(**usuario_data)
 
+log_actualizacion = obtener_logger("actualizar_usuario_parcial")
+
 # endpoint para actualizar un usuario por su documento de identidad
 @app.patch("/usuarios/{documento_identidad}", response_model=dict)
 def actualizar_usuario_parcial(documento_identidad: str, usuario: UsuarioUpdate):
-    print(f"Documento actual recibido en la URL: {documento_identidad}")
-    print(f"Datos recibidos en el cuerpo: {usuario}")
+    log_actualizacion.debug(
+        "Actualizacion recibida", extra={"datos": {"documento_identidad": documento_identidad, "cambios": usuario}}
+    )
 
     usuario_ref = db.collection("usuarios").document(documento_identidad)
+    usuario_doc = usuario_ref.get()
 
-    if not usuario_ref.get().exists:
-        print("Error: Usuario no encontrado")
+    if not usuario_doc.exists:
+        log_actualizacion.info("Usuario no encontrado", extra={"datos": {"documento_identidad": documento_identidad}})
         raise HTTPException(status_code=404, detail="usuario no encontrado")
 
-    usuario_actual = usuario_ref.get().to_dict()
-    print(f"Datos actuales del usuario: {usuario_actual}")
-
-    if usuario.documento_identidad and usuario.documento_identidad != documento_identidad:
-        print(f"Intentando cambiar el documento_identidad de {documento_identidad} a {usuario.documento_identidad}")
-        nuevo_usuario_ref = db.collection("usuarios").document(usuario.documento_identidad)
-        if nuevo_usuario_ref.get().exists:
-            print("Error: El nuevo documento de identidad ya está registrado")
-            raise HTTPException(status_code=400, detail="el nuevo documento de identidad ya esta registrado")
+    usuario_actual = usuario_doc.to_dict()
+    log_actualizacion.debug("Datos actuales del usuario", extra={"datos": usuario_actual})
 
-        nuevo_usuario_data = {**usuario_actual, **usuario.model_dump(exclude_unset=True)}
-        nuevo_usuario_data["documento_identidad"] = usuario.documento_identidad
+    update_data = usuario.model_dump(exclude_unset=True)
+    log_actualizacion.debug("Datos a actualizar", extra={"datos": update_data})
 
-        # Convertir fecha_nacimiento a string si está presente
-        if "fecha_nacimiento" in nuevo_usuario_data and isinstance(nuevo_usuario_data["fecha_nacimiento"], date):
-            nuevo_usuario_data["fecha_nacimiento"] = nuevo_usuario_data["fecha_nacimiento"].strftime("%Y-%m-%d")
+    # Convertir fecha_nacimiento a string si está presente
+    if "fecha_nacimiento" in update_data and isinstance(update_data["fecha_nacimiento"], date):
+        update_data["fecha_nacimiento"] = update_data["fecha_nacimiento"].strftime("%Y-%m-%d")
 
-        print(f"Datos del nuevo usuario: {nuevo_usuario_data}")
+    if usuario.documento_identidad and usuario.documento_identidad != documento_identidad:
+        cambio_documento = {"documento_identidad": documento_identidad, "nuevo_documento_identidad": usuario.documento_identidad}
+        log_actualizacion.debug("Cambio de documento de identidad", extra={"datos": cambio_documento})
+        nuevo_usuario_ref = db.collection("usuarios").document(usuario.documento_identidad)
 
-        nuevo_usuario_ref.set(nuevo_usuario_data)
-        print("Nuevo usuario creado")
+        # el usuario se vuelve a leer dentro de la transaccion para que las estadisticas partan del estado real
+        try:
+            escribir_con_cambio_de_foto(
+                update_data,
+                usuario_actual.get("foto"),
+                lambda: mover_usuario_transaccion(db.transaction(), usuario_ref, nuevo_usuario_ref, update_data),
+            )
+        except HTTPException as e:
+            if e.status_code == 400:
+                log_actualizacion.info("El nuevo documento de identidad ya está registrado", extra={"datos": cambio_documento})
+            raise
 
-        usuario_ref.delete()
-        print("Usuario antiguo eliminado")
+        log_actualizacion.info("Usuario movido al nuevo documento de identidad", extra={"datos": cambio_documento})
+        incrementar_version_usuarios()
 
         return {
             "message": "usuario actualizado correctamente con nuevo documento de identidad",
             "nuevo_documento_identidad": usuario.documento_identidad,
         }
 
-    update_data = usuario.model_dump(exclude_unset=True)
-    print(f"Datos a actualizar: {update_data}")
-
-    # Convertir fecha_nacimiento a string si está presente
-    if "fecha_nacimiento" in update_data and isinstance(update_data["fecha_nacimiento"], date):
-        update_data["fecha_nacimiento"] = update_data["fecha_nacimiento"].strftime("%Y-%m-%d")
-
     if not update_data:
-        print("Error: No se proporcionaron datos para actualizar")
+        log_actualizacion.info("No se proporcionaron datos para actualizar", extra={"datos": {"documento_identidad": documento_identidad}})
         raise HTTPException(status_code=400, detail="No se proporcionaron datos para actualizar.")
 
-    usuario_ref.update(update_data)
-    print("Usuario actualizado correctamente")
+    escribir_con_cambio_de_foto(
+        update_data,
+        usuario_actual.get("foto"),
+        lambda: actualizar_usuario_transaccion(db.transaction(), usuario_ref, update_data),
+    )
+    log_actualizacion.info(
+        "Usuario actualizado correctamente",
+        extra={"datos": {"documento_identidad": documento_identidad, "campos": sorted(update_data)}},
+    )
+    incrementar_version_usuarios()
 
     return {"message": "usuario actualizado correctamente", "actualizado": update_data}
 
+log_eliminacion = obtener_logger("eliminar_usuario")
+
 # endpoint para eliminar un usuario por su documento de identidad
 @app.delete("/usuarios/{documento_identidad}", response_model=dict)
 def eliminar_usuario(documento_identidad: str):
     usuario_ref = db.collection("usuarios").document(documento_identidad)
 
-    # Verificar si el usuario existe
-    if not usuario_ref.get().exists:
-        raise HTTPException(status_code=404, detail="Usuario no encontrado")
+    # Eliminar el documento del usuario en Firestore junto con los contadores de estadisticas
+    # (404 si no existe; el usuario se lee dentro de la transaccion)
+    usuario_actual = eliminar_usuario_transaccion(db.transaction(), usuario_ref)
+    incrementar_version_usuarios()
 
-    # Llamar al endpoint para borrar la foto del usuario
+    # Dejar de usar la foto del usuario (el blob se borra si nadie mas la comparte)
+    foto_actual = usuario_actual.get("foto")
+    if foto_actual and "firebasestorage" in foto_actual:
+        try:
+            liberar_foto(storage.bucket(NOMBRE_BUCKET), foto_actual)
+        except Exception:
+            log_eliminacion.warning("Error al intentar eliminar archivo del bucket", exc_info=True)
+
+    return {"message": "Usuario y su foto eliminados correctamente"}
+
+# extraer la carpeta y el nombre del archivo de la URL de una foto
+def nombre_blob_foto(foto_url: str) -> str:
+    return "/".join(foto_url.split("/")[-2:])
+
+# sumar un usuario a las referencias de una foto; devuelve True si el blob aun no esta subido
+# (sin generacion puede que otra subida siga en curso o haya fallado, volver a subir el mismo contenido no hace daño)
+@firestore.transactional
+def sumar_referencia_foto(transaccion, foto_ref) -> bool:
+    foto_doc = foto_ref.get(transaction=transaccion)
+    if foto_doc.exists:
+        transaccion.update(foto_ref, {"referencias": foto_doc.get("referencias") + 1})
+        return not foto_doc.to_dict().get("generacion")
+    transaccion.set(foto_ref, {"referencias": 1})
+    return True
+
+# guardar la generacion del blob subido (si dos subidas coinciden se queda la mas reciente)
+@firestore.transactional
+def guardar_generacion_foto(transaccion, foto_ref, generacion: int):
+    foto_doc = foto_ref.get(transaction=transaccion)
+    if foto_doc.exists and generacion > (foto_doc.to_dict().get("generacion") or 0):
+        transaccion.update(foto_ref, {"generacion": generacion})
+
+# restar un usuario a las referencias de una foto; devuelve la generacion del blob si hay que borrarlo
+@firestore.transactional
+def restar_referencia_foto(transaccion, foto_ref):
+    foto_doc = foto_ref.get(transaction=transaccion)
+    if not foto_doc.exists:
+        return None
+    foto_data = foto_doc.to_dict()
+    if foto_data.get("referencias", 0) > 1:
+        transaccion.update(foto_ref, {"referencias": foto_data["referencias"] - 1})
+        return None
+    transaccion.delete(foto_ref)
+    return foto_data.get("generacion")
+
+# comprobar si una URL es una foto de nuestro bucket guardada por contenido (con contador de referencias)
+def es_foto_por_contenido(foto_url: Optional[str]) -> bool:
+    return bool(foto_url) and "firebasestorage" in foto_url and bool(REGEX_HASH_FOTO.match(nombre_blob_foto(foto_url).split("/")[-1]))
+
+# sumar una referencia a una foto ya existente cuando un usuario pasa a usar su URL (PATCH o importaciones)
+def adquirir_foto(foto_url: Optional[str]):
+    if es_foto_por_contenido(foto_url):
+        hash_foto = nombre_blob_foto(foto_url).split("/")[-1]
+        sumar_referencia_foto(db.transaction(), db.collection("fotos").document(hash_foto))
+
+# dejar de usar la URL de una foto puesta con PATCH o importaciones (solo las de nuestro bucket)
+def soltar_foto(foto_url: Optional[str]):
+    if foto_url and "firebasestorage" in foto_url:
+        liberar_foto(storage.bucket(NOMBRE_BUCKET), foto_url)
+
+# mensaje de error si la URL no se puede asignar a mano (las fotos antiguas de nuestro bucket no tienen contador)
+def error_foto_asignada(foto_url: Optional[str]) -> Optional[str]:
+    if foto_url and "firebasestorage" in foto_url and not es_foto_por_contenido(foto_url):
+        return "Solo se pueden asignar fotos del bucket subidas con /usuarios/{documento_identidad}/foto"
+    return None
+
+# cambiar la foto de un usuario con PATCH: sumar la referencia de la nueva antes de escribir,
+# soltarla si la escritura falla y soltar la anterior (la leida en la transaccion) cuando la nueva ya esta guardada
+# escribir() devuelve el usuario tal y como estaba antes del cambio
+def escribir_con_cambio_de_foto(cambios: dict, foto_leida: Optional[str], escribir) -> dict:
+    # sin foto en los cambios, o reenviando la misma foto sin contador, no hay referencias que tocar
+    if "foto" not in cambios or (cambios["foto"] == foto_leida and not es_foto_por_contenido(foto_leida)):
+        return escribir()
+
+    foto_nueva = cambios["foto"]
+    error = error_foto_asignada(foto_nueva)
+    if error:
+        raise HTTPException(status_code=400, detail=error)
+
+    adquirir_foto(foto_nueva)
     try:
-        borrar_foto(documento_identidad)
-    except HTTPException as e:
-        if e.status_code != 404:  # Ignorar si no tiene foto, pero relanzar otros errores
-            raise e
+        usuario_anterior = escribir()
+    except Exception:
+        soltar_foto(foto_nueva)
+        raise
 
-    # Eliminar el documento del usuario en Firestore
-    usuario_ref.delete()
+    # si la foto no cambiaba esto deshace la referencia que se acaba de sumar
+    try:
+        soltar_foto(usuario_anterior.get("foto"))
+    except Exception:
+        log_actualizacion.warning("Error al soltar la foto anterior", exc_info=True)  # Log, pero no interrumpir
+    return usuario_anterior
+
+# dejar de usar una foto y borrar el blob si ningun otro usuario la comparte
+# (sin comprobar antes si existe, ahorra la llamada a exists())
+def liberar_foto(bucket, foto_url: str):
+    blob_name = nombre_blob_foto(foto_url)
+    hash_foto = blob_name.split("/")[-1]
+
+    if not REGEX_HASH_FOTO.match(hash_foto):
+        # foto antigua con nombre propio del usuario: no la comparte nadie
+        try:
+            bucket.blob(blob_name).delete()
+        except NotFound:
+            pass  # el archivo ya no existe, no es un error
+        return
 
-    return {"message": "Usuario y su foto eliminados correctamente"}
+    generacion = restar_referencia_foto(db.transaction(), db.collection("fotos").document(hash_foto))
+    if generacion is None:
+        return  # otros usuarios siguen usando la foto o aun no hay un blob subido que se pueda borrar con seguridad
+
+    try:
+        # si otra subida ha vuelto a crear el blob mientras tanto, la generacion ya no coincide y no se borra
+        bucket.blob(blob_name).delete(if_generation_match=generacion)
+    except (NotFound, PreconditionFailed):
+        pass
+
+# endpoint para eliminar varios usuarios y sus fotos a la vez
+@app.post("/usuarios/eliminar-lote", response_model=dict)
+def eliminar_usuarios_lote(eliminacion: EliminacionLote):
+    documentos = list(dict.fromkeys(d.upper() for d in eliminacion.documentos))
+
+    if not documentos:
+        raise HTTPException(status_code=400, detail="No se proporcionaron documentos de identidad")
+
+    if len(documentos) > MAX_DOCUMENTOS_ELIMINACION:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Se pueden eliminar como maximo {MAX_DOCUMENTOS_ELIMINACION} usuarios por peticion",
+        )
+
+    resultados = {d: {"usuario": d, "status": "error", "mensaje": "Usuario no encontrado"} for d in documentos}
+
+    # los documentos con formato no valido se informan sin tocar Firestore (con "/" formarian otra ruta)
+    for d in documentos:
+        if not REGEX_DOCUMENTO.match(d):
+            resultados[d]["mensaje"] = "El documento de identidad debe ser alfanumérico y tener entre 6 y 15 caracteres."
+    validos = [d for d in documentos if REGEX_DOCUMENTO.match(d)]
+
+    bucket = storage.bucket(NOMBRE_BUCKET)
+    usuarios_eliminados = 0
+
+    with ThreadPoolExecutor(max_workers=MAX_HILOS_BORRADO_FOTOS) as executor:
+        borrados_fotos = {}
+
+        # cada usuario son dos operaciones en el batch (borrado y marca de eliminado), mas una para las estadisticas
+        tamano_grupo = (TAMANO_BATCH_FIRESTORE - 1) // 2
+        for inicio in range(0, len(validos), tamano_grupo):
+            refs = [db.collection("usuarios").document(d) for d in validos[inicio : inicio + tamano_grupo]]
+
+            # leer solo los campos necesarios de todos los documentos del grupo en una sola RPC
+            campos = ["foto", "fecha_nacimiento", "email"]
+            existentes = [snapshot for snapshot in db.get_all(refs, field_paths=campos) if snapshot.exists]
+            if not existentes:
+                continue
+
+            batch = db.batch()
+            for snapshot in existentes:
+                # si el usuario cambia entre la lectura y el borrado el batch falla y las estadisticas no se desvian
+                batch.delete(snapshot.reference, option=db.write_option(last_update_time=snapshot.update_time))
+                marcar_eliminado(snapshot.id, batch)
+            registrar_bajas(batch, [snapshot.to_dict() for snapshot in existentes])
+
+            try:
+                batch.commit()
+            except Exception as e:
+                for snapshot in existentes:
+                    resultados[snapshot.id]["mensaje"] = f"Error al eliminar el usuario: {str(e)}"
+                continue
+
+            for snapshot in existentes:
+                resultados[snapshot.id] = {"usuario": snapshot.id, "status": "éxito", "mensaje": "Usuario eliminado correctamente"}
+            usuarios_eliminados += len(existentes)
+
+            # borrar las fotos en paralelo mientras se procesa el siguiente grupo
+            for snapshot in existentes:
+                foto = snapshot.to_dict().get("foto")
+                if foto and "firebasestorage" in foto:
+                    borrados_fotos[snapshot.id] = executor.submit(liberar_foto, bucket, foto)
+
+        # esperar a que terminen los borrados de fotos y anotar los fallos
+        for documento, futuro in borrados_fotos.items():
+            try:
+                futuro.result()
+            except Exception as e:
+                resultados[documento]["mensaje"] += f" (error al eliminar la foto: {str(e)})"
+
+    if usuarios_eliminados:
+        incrementar_version_usuarios()
+
+    return {
+        "resultados": list(resultados.values()),
+        "resumen": {
+            "total_procesados": len(documentos),
+            "eliminados_correctamente": usuarios_eliminados,
+            "con_errores": len(documentos) - usuarios_eliminados,
+        },
+    }
 
 # endpoint para buscar usuarios por email (búsqueda parcial)
 @app.get("/usuarios/email/{email}", response_model=dict)
-def buscar_por_email(email: str, skip: int = 0, limit: int = 3):
+def buscar_por_email(email: str, request: Request, response: Response, skip: int = 0, limit: int = 3):
     email = email.lower()
+    # el indice compartido solo se usa si esta al dia con la version actual de Firestore
+    version = obtener_version_usuarios()
+    indice = obtener_indice(version)
+
+    # ETag a partir de la version de la coleccion: si no hubo escrituras devolver 304 sin recorrer usuarios
+    etag = generar_etag(version, "email", email, skip, limit)
+    if etag_coincide(request, etag):
+        return respuesta_no_modificada(etag)
+    response.headers["ETag"] = etag
+
+    if indice is not None:
+        return paginar_indice(indice, indice.buscar("email", email), skip, limit, "No se encontraron usuarios con ese email")
+
     usuarios_ref = db.collection("usuarios").stream()
     usuarios = []
 
@@ -246,9 +880,25 @@ def buscar_por_email(email: str, skip: int = 0, limit: int = 3):
 
 # endpoint para buscar usuarios por nombre sin importar mayusculas ni acentos
 @app.get("/usuarios/nombre/{nombre}", response_model=dict)
-def buscar_por_nombre(nombre: str, skip: int = 0, limit: int = 3):
+def buscar_por_nombre(nombre: str, request: Request, response: Response, skip: int = 0, limit: int = 3):
     nombre_normalizado = normalizar_texto(nombre)
 
+    # el indice compartido solo se usa si esta al dia con la version actual de Firestore
+    version = obtener_version_usuarios()
+    indice = obtener_indice(version)
+
+    # ETag a partir de la version de la coleccion: si no hubo escrituras devolver 304 sin recorrer usuarios
+    etag = generar_etag(version, "nombre", nombre_normalizado, skip, limit)
+    if etag_coincide(request, etag):
+        return respuesta_no_modificada(etag)
+    response.headers["ETag"] = etag
+
+    if indice is not None:
+        return paginar_indice(
+            indice, indice.buscar("nombre_normalizado", nombre_normalizado), skip, limit,
+            "no se encontraron usuarios con ese nombre",
+        )
+
     try:
         # buscar usuarios cuyo nombre normalizado contenga la palabra clave
         usuarios_ref = db.collection("usuarios").stream()
@@ -283,10 +933,26 @@ def buscar_por_nombre(nombre: str, skip: int = 0, limit: int = 3):
 
 # endpoint para buscar usuarios por documento de identidad (busqueda parcial)
 @app.get("/usuarios/documento/{documento_identidad}", response_model=dict)
-def buscar_por_documento(documento_identidad: str, skip: int = 0, limit: int = 3):
+def buscar_por_documento(documento_identidad: str, request: Request, response: Response, skip: int = 0, limit: int = 3):
     # convertir el documento de identidad recibido a mayusculas
     documento_identidad = documento_identidad.upper()
 
+    # el indice compartido solo se usa si esta al dia con la version actual de Firestore
+    version = obtener_version_usuarios()
+    indice = obtener_indice(version)
+
+    # ETag a partir de la version de la coleccion: si no hubo escrituras devolver 304 sin recorrer usuarios
+    etag = generar_etag(version, "documento", documento_identidad, skip, limit)
+    if etag_coincide(request, etag):
+        return respuesta_no_modificada(etag)
+    response.headers["ETag"] = etag
+
+    if indice is not None:
+        return paginar_indice(
+            indice, indice.buscar("documento_identidad", documento_identidad), skip, limit,
+            "No se encontraron usuarios con ese documento de identidad",
+        )
+
     try:
         # buscar usuarios cuyo documento de identidad contenga el valor buscado
         usuarios_ref = db.collection("usuarios").stream()
@@ -324,9 +990,30 @@ def buscar_por_documento(documento_identidad: str, skip: int = 0, limit: int = 3
 @app.get("/usuarios/buscar/{valor}", response_model=dict)
 def buscar_usuarios_por_ruta(
     valor: str,
+    request: Request,
+    response: Response,
     skip: int = 0,
     limit: int = 3
 ):
+    # el indice compartido solo se usa si esta al dia con la version actual de Firestore
+    version = obtener_version_usuarios()
+    indice = obtener_indice(version)
+
+    # ETag a partir de la version de la coleccion: si no hubo escrituras devolver 304 sin recorrer usuarios
+    etag = generar_etag(version, "buscar", valor, skip, limit)
+    if etag_coincide(request, etag):
+        return respuesta_no_modificada(etag)
+    response.headers["ETag"] = etag
+
+    if indice is not None:
+        # union de las tres busquedas manteniendo el orden de la coleccion
+        posiciones = sorted(
+            set(indice.buscar("documento_identidad", valor.upper()))
+            | set(indice.buscar("nombre_normalizado", normalizar_texto(valor)))
+            | set(indice.buscar("email", valor.lower()))
+        )
+        return paginar_indice(indice, posiciones, skip, limit, "No se encontraron usuarios con el valor proporcionado")
+
     try:
         usuarios_ref = db.collection("usuarios").stream()
         usuarios = []
@@ -373,7 +1060,20 @@ def buscar_usuarios_por_ruta(
 
 # endpoint para obtener todos los usuarios con paginación y total
 @app.get("/usuarios", response_model=dict)
-def obtener_todos_los_usuarios(skip: int = 0, limit: int = 3):
+def obtener_todos_los_usuarios(request: Request, response: Response, skip: int = 0, limit: int = 3):
+    # el indice compartido solo se usa si esta al dia con la version actual de Firestore
+    version = obtener_version_usuarios()
+    indice = obtener_indice(version)
+
+    # ETag a partir de la version de la coleccion: si no hubo escrituras devolver 304 sin recorrer usuarios
+    etag = generar_etag(version, "todos", "", skip, limit)
+    if etag_coincide(request, etag):
+        return respuesta_no_modificada(etag)
+    response.headers["ETag"] = etag
+
+    if indice is not None:
+        return paginar_indice(indice, indice.todos(), skip, limit, "No hay usuarios registrados")
+
     usuarios_ref = db.collection("usuarios").stream()
     usuarios = []
 
@@ -393,14 +1093,17 @@ def obtener_todos_los_usuarios(skip: int = 0, limit: int = 3):
 
     return {"usuarios": paginados, "total": total}
 
+log_subida_foto = obtener_logger("subir_foto")
+
 #endpoint para subir imagenes
 @app.post("/usuarios/{documento_identidad}/foto")
 async def subir_foto(documento_identidad: str, file: UploadFile = File(...)):
     try:
         usuario_ref = db.collection("usuarios").document(documento_identidad)
+        usuario_doc = usuario_ref.get()
 
         # Verificar si el usuario existe
-        if not usuario_ref.get().exists:
+        if not usuario_doc.exists:
             raise HTTPException(status_code=404, detail="Usuario no encontrado")
 
         # Validar que solo se haya enviado un archivo
@@ -409,7 +1112,7 @@ async def subir_foto(documento_identidad: str, file: UploadFile = File(...)):
 
         # Verificar el content-type del archivo
         content_type = file.content_type
-        print(f"Content-Type recibido: {content_type}")  # Log para depuración
+        log_subida_foto.debug("Content-Type recibido", extra={"datos": {"content_type": content_type}})
         
         # Lista completa de tipos MIME de imágenes permitidos (corregido)
         tipos_permitidos = [
@@ -425,51 +1128,61 @@ async def subir_foto(documento_identidad: str, file: UploadFile = File(...)):
                 detail=f"Tipo de archivo no permitido: {content_type}. Solo se permiten PNG, JPG, JPEG, HEIC, HEIF o WEBP"
             )
 
-        # Intentar leer los primeros bytes para verificar si es una imagen real
+        # Leer el archivo por bloques calculando su hash SHA-256 (el hash es el nombre del blob)
         try:
-            content = await file.read(1024)  # Leer solo los primeros bytes
-            file.file.seek(0)  # Regresar al inicio del archivo
+            sha256 = hashlib.sha256()
+            while bloque := await file.read(TAMANO_BLOQUE_FOTO):
+                sha256.update(bloque)
+            await file.seek(0)  # Regresar al inicio del archivo
         except Exception as e:
             raise HTTPException(status_code=400, detail=f"No se pudo leer el archivo: {str(e)}")
 
-        # Llamar al endpoint para obtener la foto actual del usuario
-        try:
-            foto_actual = obtener_foto(documento_identidad)["foto"]
-        except HTTPException as e:
-            if e.status_code == 404:
-                foto_actual = None  # El usuario no tiene foto
-            else:
-                raise e  # Relanzar otros errores
+        hash_foto = sha256.hexdigest()
+        blob_name = f"usuarios/{hash_foto}"
+
+        # Obtener la foto actual del usuario del documento ya leido (None si no tiene foto)
+        usuario_actual = usuario_doc.to_dict()
+        foto_actual = usuario_actual.get("foto")
+
+        # Si el usuario vuelve a enviar la misma imagen no hay nada que borrar ni subir
+        if foto_actual and nombre_blob_foto(foto_actual) == blob_name:
+            return {"message": "La foto no ha cambiado", "foto": foto_actual}
 
         # Especificar el nombre del bucket explícitamente
-        bucket = storage.bucket("pf25-carlos-db.firebasestorage.app")
+        bucket = storage.bucket(NOMBRE_BUCKET)
+        blob = bucket.blob(blob_name)
+        foto_ref = db.collection("fotos").document(hash_foto)
 
-        # Eliminar la foto anterior si existe
-        if foto_actual:
+        # Subir la foto solo si no hay ya un blob subido con la misma imagen
+        if sumar_referencia_foto(db.transaction(), foto_ref):
             try:
-                blob_anterior = bucket.blob("/".join(foto_actual.split("/")[-2:]))
-                if blob_anterior.exists():
-                    blob_anterior.delete()
+                blob.cache_control = CACHE_CONTROL_FOTOS
+                blob.upload_from_file(file.file, content_type=file.content_type)
+                blob.make_public()
+                guardar_generacion_foto(db.transaction(), foto_ref, blob.generation)
             except Exception as e:
-                print(f"Error al eliminar foto anterior: {str(e)}")  # Log, pero no interrumpir
-
-        # Generar un nombre seguro para el archivo (evitar caracteres especiales)
-        import time
-        safe_filename = f"{documento_identidad}_{int(time.time())}.jpg"
-        blob = bucket.blob(f"usuarios/{safe_filename}")
-        
-        # Subir la nueva foto
-        try:
-            blob.upload_from_file(file.file, content_type=file.content_type)
-            blob.make_public()
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Error al subir la foto: {str(e)}")
+                liberar_foto(bucket, blob.public_url)
+                raise HTTPException(status_code=500, detail=f"Error al subir la foto: {str(e)}")
 
-        # Hacer que el archivo sea público y obtener la URL
+        # La URL depende solo del contenido, asi que se puede cachear para siempre
         public_url = blob.public_url
 
         # Actualizar el campo foto del usuario con la nueva URL pública
-        usuario_ref.update({"foto": public_url})
+        # (la foto anterior se vuelve a leer dentro de la transaccion junto con las estadisticas)
+        try:
+            usuario_anterior = actualizar_usuario_transaccion(db.transaction(), usuario_ref, {"foto": public_url})
+        except Exception:
+            liberar_foto(bucket, public_url)
+            raise
+        incrementar_version_usuarios()
+
+        # Dejar de usar la foto anterior (se borra si nadie mas la comparte)
+        foto_actual = usuario_anterior.get("foto")
+        if foto_actual and "firebasestorage" in foto_actual:
+            try:
+                liberar_foto(bucket, foto_actual)
+            except Exception:
+                log_subida_foto.warning("Error al eliminar foto anterior", exc_info=True)  # Log, pero no interrumpir
 
         return {"message": "Foto subida correctamente", "foto": public_url}
         
@@ -477,68 +1190,57 @@ async def subir_foto(documento_identidad: str, file: UploadFile = File(...)):
         # Relanzar excepciones HTTP
         raise e
     except Exception as e:
-        # Log detallado para depuración
-        import traceback
-        print(f"Error al subir foto: {str(e)}")
-        print(traceback.format_exc())
+        # Log detallado para depuración (la traza se formatea en el hilo del listener)
+        log_subida_foto.exception("Error al subir foto", extra={"datos": {"documento_identidad": documento_identidad}})
         raise HTTPException(status_code=500, detail=f"Error interno al subir la foto: {str(e)}")
 
 
+log_borrado_foto = obtener_logger("borrar_foto")
+
 # endpoint para borrar la foto de un usuario
 @app.delete("/usuarios/{documento_identidad}/foto", response_model=dict)
 def borrar_foto(documento_identidad: str):
     usuario_ref = db.collection("usuarios").document(documento_identidad)
 
-    # verificar si el usuario existe
-    if not usuario_ref.get().exists:
-        raise HTTPException(status_code=404, detail="Usuario no encontrado")
-
-    # obtener la URL de la foto actual
-    usuario_data = usuario_ref.get().to_dict()
-    foto_actual = usuario_data.get("foto")
-
-    if not foto_actual:
-        raise HTTPException(status_code=404, detail="Este usuario no tiene foto para borrar")
+    # Limpiar el campo foto y las estadisticas en una transaccion (404 si el usuario no existe o no tiene foto)
+    foto_actual = quitar_foto_transaccion(db.transaction(), usuario_ref)
 
     # Verificar si la URL parece ser de Firebase Storage
     if "firebasestorage" in foto_actual:
         try:
-            # extraer el nombre del archivo del path completo
-            bucket = storage.bucket("pf25-carlos-db.firebasestorage.app")
-            blob_name = "/".join(foto_actual.split("/")[-2:])  # Extraer la carpeta y el nombre del archivo
-            blob = bucket.blob(blob_name)
-
-            # verificar si el archivo existe antes de intentar eliminarlo
-            if blob.exists():
-                blob.delete()
-                print(f"Archivo {blob_name} eliminado correctamente del bucket")
-            else:
-                print(f"Advertencia: El archivo {blob_name} no existe en el bucket")
-        except Exception as e:
-            print(f"Error al intentar eliminar archivo del bucket: {str(e)}")
+            # borrar el archivo del bucket si ningun otro usuario comparte la misma foto
+            liberar_foto(storage.bucket(NOMBRE_BUCKET), foto_actual)
+            log_borrado_foto.info("Foto liberada correctamente", extra={"datos": {"blob": nombre_blob_foto(foto_actual)}})
+        except Exception:
+            log_borrado_foto.warning("Error al intentar eliminar archivo del bucket", exc_info=True)
             # Continuamos con la operación a pesar del error
     else:
-        print(f"La URL {foto_actual} no parece ser de Firebase Storage")
+        log_borrado_foto.info("La URL no parece ser de Firebase Storage", extra={"datos": {"documento_identidad": documento_identidad}})
 
-    # Actualizar el campo foto en Firestore siempre, independientemente de si se pudo borrar el archivo
-    usuario_ref.update({"foto": None})
+    incrementar_version_usuarios()
 
     return {"message": "Campo de foto limpiado correctamente"}
 
 #endpoint para obtener la foto de un usuario
 @app.get("/usuarios/{documento_identidad}/foto")
-def obtener_foto(documento_identidad: str):
-    usuario_ref = db.collection("usuarios").document(documento_identidad)
+def obtener_foto(documento_identidad: str, request: Request, response: Response):
+    usuario_doc = db.collection("usuarios").document(documento_identidad).get()
 
-    if not usuario_ref.get().exists:
+    if not usuario_doc.exists:
         raise HTTPException(status_code=404, detail="Usuario no encontrado")
 
-    usuario_data = usuario_ref.get().to_dict()
+    usuario_data = usuario_doc.to_dict()
     foto = usuario_data.get("foto")
 
     if not foto:
         raise HTTPException(status_code=404, detail="Este usuario no tiene foto")
 
+    # ETag del documento: si no ha cambiado devolver 304
+    etag = etag_documento(usuario_doc, "foto")
+    if etag_coincide(request, etag):
+        return respuesta_no_modificada(etag)
+    response.headers["ETag"] = etag
+
     return {"foto": foto}
 
 
@@ -568,256 +1270,256 @@ def buscar_por_documento_exacto(documento_identidad: str):
     usuario_data["fecha_nacimiento"] = date.fromisoformat(usuario_data["fecha_nacimiento"])
     return Usuario(**usuario_data)
 
-#endpoint para registrar varios usuarios a la vez
-@app.post("/usuarios/multiples", response_model=dict)
-async def registrar_usuarios_multiples(usuarios: List[Usuario]):
-    resultados = []
-    usuarios_procesados = 0
-    usuarios_registrados = 0
-    usuarios_con_error = 0
-    
-    for usuario in usuarios:
+# endpoint para obtener varios usuarios en una sola llamada a Firestore
+@app.post("/usuarios/lote", response_model=dict)
+def obtener_usuarios_lote(consulta: ConsultaLote):
+    # normalizar a mayusculas igual que obtener_usuario y quitar duplicados manteniendo el orden
+    documentos = list(dict.fromkeys(d.upper() for d in consulta.documentos))
+
+    if not documentos:
+        raise HTTPException(status_code=400, detail="No se proporcionaron documentos de identidad")
+
+    if len(documentos) > MAX_DOCUMENTOS_LOTE:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Se pueden consultar como maximo {MAX_DOCUMENTOS_LOTE} usuarios por peticion",
+        )
+
+    campos = None
+    if consulta.campos is not None:
+        campos_invalidos = [c for c in consulta.campos if c not in CAMPOS_CONSULTABLES]
+        if campos_invalidos:
+            raise HTTPException(status_code=400, detail=f"Campos no permitidos: {', '.join(campos_invalidos)}")
+        # incluir siempre el documento para que el cliente pueda identificar cada usuario
+        campos = list(dict.fromkeys(["documento_identidad", *consulta.campos]))
+
+    # los documentos con formato no valido no se consultan (con "/" formarian otra ruta de Firestore)
+    invalidos = [d for d in documentos if not REGEX_DOCUMENTO.match(d)]
+    validos = [d for d in documentos if REGEX_DOCUMENTO.match(d)]
+
+    # una sola RPC para todos los documentos
+    refs = [db.collection("usuarios").document(d) for d in validos]
+    snapshots = db.get_all(refs, field_paths=campos) if refs else []
+
+    encontrados = {}
+    for snapshot in snapshots:
+        if not snapshot.exists:
+            continue
+        usuario_data = snapshot.to_dict()
+        if campos is None:
+            usuario_data["fecha_nacimiento"] = date.fromisoformat(usuario_data["fecha_nacimiento"])
+            encontrados[snapshot.id] = Usuario(**usuario_data)
+        else:
+            encontrados[snapshot.id] = usuario_data
+
+    # get_all no garantiza el orden, devolver en el orden pedido
+    return {
+        "usuarios": [encontrados[d] for d in documentos if d in encontrados],
+        "encontrados": [d for d in documentos if d in encontrados],
+        "no_encontrados": [d for d in validos if d not in encontrados],
+        "invalidos": invalidos,
+        "total": len(encontrados),
+    }
+
+# comprobar las filas de una importacion antes de hacer ninguna llamada a Firestore
+# devuelve los usuarios validos como (indice, Usuario) y los errores como {indice: (documento, mensaje)}
+def prevalidar_usuarios(filas: List[dict]):
+    errores = {}
+
+    # extraer las columnas una sola vez
+    columnas = {campo: [fila.get(campo) for fila in filas] for campo in CAMPOS_REQUERIDOS + ["foto"]}
+    documentos = [str(d).upper() if d else "desconocido" for d in columnas["documento_identidad"]]
+
+    # campos requeridos
+    for i in range(len(filas)):
+        campos_faltantes = [campo for campo in CAMPOS_REQUERIDOS if not columnas[campo][i]]
+        if campos_faltantes:
+            errores[i] = f"Faltan campos requeridos: {', '.join(campos_faltantes)}"
+
+    # documento de identidad con la expresion regular ya compilada
+    for i, documento in enumerate(columnas["documento_identidad"]):
+        if i not in errores and not REGEX_DOCUMENTO.match(documento):
+            errores[i] = "El documento de identidad debe ser alfanumérico y tener entre 6 y 15 caracteres."
+
+    # nombre no vacio
+    for i, nombre in enumerate(columnas["nombre"]):
+        if i not in errores and not nombre.strip():
+            errores[i] = "El nombre no puede estar vacío."
+
+    # las fotos del bucket solo se pueden asignar si estan guardadas por contenido
+    for i, foto in enumerate(columnas["foto"]):
+        error = error_foto_asignada(foto)
+        if i not in errores and error:
+            errores[i] = error
+
+    # fechas de nacimiento en bloque
+    fechas = parsear_fechas(columnas["fecha_nacimiento"])
+    for i, fecha in enumerate(fechas):
+        if i not in errores and isinstance(fecha, str):
+            errores[i] = fecha  # parsear_fechas devuelve el mensaje de error en lugar de la fecha
+
+    # validar el email con el modelo (sin red) y detectar duplicados dentro del propio archivo
+    validos = []
+    documentos_vistos = {}
+    emails_vistos = {}
+    for i in range(len(filas)):
+        if i in errores:
+            continue
+
+        usuario_params = {
+            "nombre": columnas["nombre"][i],
+            "email": columnas["email"][i],
+            "documento_identidad": documentos[i],
+            "fecha_nacimiento": fechas[i],
+        }
+        if columnas["foto"][i]:
+            usuario_params["foto"] = columnas["foto"][i]
+
         try:
-            # Validación del documento de identidad
-            if not re.match(r"^[a-zA-Z0-9]{6,15}$", usuario.documento_identidad):
-                resultados.append({
-                    "usuario": usuario.documento_identidad, 
-                    "status": "Error", 
-                    "mensaje": "El documento de identidad debe ser alfanumérico y tener entre 6 y 15 caracteres."
-                })
-                usuarios_con_error += 1
-                continue
-            
-            # Convertir a mayúsculas el documento de identidad
-            usuario.documento_identidad = usuario.documento_identidad.upper()
-            usuario_ref = db.collection("usuarios").document(usuario.documento_identidad)
-
-            # Verificar si el usuario ya existe
-            if usuario_ref.get().exists:
-                resultados.append({
-                    "usuario": usuario.documento_identidad, 
-                    "status": "Error", 
-                    "mensaje": "El documento ya está registrado."
-                })
-                usuarios_con_error += 1
+            usuario = Usuario(**usuario_params)
+        except ValueError as ve:
+            errores[i] = f"Error de validación: {str(ve)}"
+            continue
+
+        usuario.email = usuario.email.lower()
+
+        if usuario.documento_identidad in documentos_vistos:
+            errores[i] = f"El documento está repetido en el archivo (fila {documentos_vistos[usuario.documento_identidad] + 1})."
+            continue
+        if usuario.email in emails_vistos:
+            errores[i] = f"El email {usuario.email} está repetido en el archivo (fila {emails_vistos[usuario.email] + 1})."
+            continue
+
+        documentos_vistos[usuario.documento_identidad] = i
+        emails_vistos[usuario.email] = i
+        validos.append((i, usuario))
+
+    return validos, {i: (documentos[i], mensaje) for i, mensaje in errores.items()}
+
+# convertir una columna de fechas YYYY-MM-DD a date (o al mensaje de error si no es valida)
+def parsear_fechas(valores: list) -> list:
+    hoy = date.today()
+    fechas = []
+    for valor in valores:
+        if isinstance(valor, date):
+            fecha = valor
+        else:
+            coincidencia = REGEX_FECHA.match(valor or "")
+            try:
+                fecha = date(*map(int, coincidencia.groups())) if coincidencia else None
+            except ValueError:
+                fecha = None
+            if fecha is None:
+                fechas.append("Formato de fecha incorrecto. Debe ser YYYY-MM-DD.")
                 continue
 
-            # Validar formato de email y convertir a minúsculas
-            usuario.email = usuario.email.lower()
-            
-            # Verificar si el email ya existe
-            email_ref = db.collection("usuarios").where("email", "==", usuario.email).get()
-            if email_ref:
-                resultados.append({
-                    "usuario": usuario.documento_identidad, 
-                    "status": "Error", 
-                    "mensaje": f"El email {usuario.email} ya está registrado con otro usuario."
-                })
-                usuarios_con_error += 1
-                continue
-            
-            # Validar fecha de nacimiento
-            if usuario.fecha_nacimiento >= date.today():
-                resultados.append({
-                    "usuario": usuario.documento_identidad, 
-                    "status": "Error", 
-                    "mensaje": "La fecha de nacimiento no puede ser hoy ni en el futuro."
-                })
-                usuarios_con_error += 1
-                continue
-            
-            # Validar que el nombre no esté vacío
-            if not usuario.nombre or usuario.nombre.strip() == "":
-                resultados.append({
-                    "usuario": usuario.documento_identidad, 
-                    "status": "Error", 
-                    "mensaje": "El nombre no puede estar vacío."
-                })
-                usuarios_con_error += 1
-                continue
+        if fecha >= hoy:
+            fechas.append("La fecha de nacimiento no puede ser hoy ni en el futuro.")
+        else:
+            fechas.append(fecha)
+    return fechas
 
-            # Preparar los datos del usuario
-            usuario_dict = usuario.model_dump()
-            usuario_dict["fecha_nacimiento"] = usuario.fecha_nacimiento.strftime("%Y-%m-%d")
-            usuario_dict["nombre_normalizado"] = normalizar_texto(usuario.nombre)
-            usuario_dict["nombre_minusculas"] = usuario.nombre.lower()
-            usuario_dict["email"] = usuario.email
-            usuario_dict["documento_identidad"] = usuario.documento_identidad
-            
-            # Si se proporcionó una URL de foto, la mantenemos
-            if usuario.foto:
-                usuario_dict["foto"] = usuario.foto
-
-            # Guardar en Firestore
-            usuario_ref.set(usuario_dict)
-            resultados.append({
-                "usuario": usuario.documento_identidad, 
-                "status": "Éxito", 
-                "mensaje": "Usuario registrado correctamente."
-            })
-            usuarios_registrados += 1
-            
-        except ValueError as ve:
-            # Capturar errores de validación específicos
-            resultados.append({
-                "usuario": getattr(usuario, "documento_identidad", "desconocido"), 
-                "status": "Error", 
-                "mensaje": f"Error de validación: {str(ve)}"
-            })
-            usuarios_con_error += 1
-        except Exception as e:
-            # Capturar otros errores inesperados
-            resultados.append({
-                "usuario": getattr(usuario, "documento_identidad", "desconocido"), 
-                "status": "Error", 
-                "mensaje": f"Error inesperado: {str(e)}"
-            })
-            usuarios_con_error += 1
-        
-        usuarios_procesados += 1
+# guardar en Firestore un usuario ya prevalidado y devolver el mensaje de error o None si se registro
+def guardar_usuario_importado(usuario: Usuario) -> Optional[str]:
+    usuario_ref = db.collection("usuarios").document(usuario.documento_identidad)
+
+    # Verificar si el usuario ya existe
+    if usuario_ref.get().exists:
+        return "El documento ya está registrado."
+
+    # Verificar si el email ya existe
+    if db.collection("usuarios").where("email", "==", usuario.email).get():
+        return f"El email {usuario.email} ya está registrado con otro usuario."
+
+    # Preparar los datos del usuario
+    usuario_dict = usuario.model_dump()
+    usuario_dict["fecha_nacimiento"] = usuario.fecha_nacimiento.strftime("%Y-%m-%d")
+    usuario_dict["nombre_normalizado"] = normalizar_texto(usuario.nombre)
+    usuario_dict["nombre_minusculas"] = usuario.nombre.lower()
+
+    # la foto importada cuenta como una referencia mas (se suelta si no se llega a guardar)
+    adquirir_foto(usuario.foto)
+
+    # Guardar en Firestore junto con los contadores de estadisticas
+    try:
+        crear_usuario(usuario_ref, usuario_dict)
+    except AlreadyExists:
+        soltar_foto(usuario.foto)
+        return "El documento ya está registrado."
+    except Exception:
+        soltar_foto(usuario.foto)
+        raise
+    return None
+
+# procesar una importacion: prevalidar todo, y si no es dry_run guardar los usuarios validos
+def procesar_importacion(filas: List[dict], dry_run: bool, estado_exito: str, estado_error: str) -> dict:
+    validos, errores = prevalidar_usuarios(filas)
+    resultados = {
+        i: {"usuario": documento, "status": estado_error, "mensaje": mensaje}
+        for i, (documento, mensaje) in errores.items()
+    }
+
+    # en modo dry_run se devuelve el informe de validacion sin tocar Firestore
+    if dry_run:
+        for i, usuario in validos:
+            resultados[i] = {"usuario": usuario.documento_identidad, "status": "valido", "mensaje": "Usuario válido."}
+        return {
+            "resultados": [resultados[i] for i in sorted(resultados)],
+            "resumen": {
+                "total_procesados": len(filas),
+                "validos": len(validos),
+                "con_errores": len(errores),
+            },
+            "dry_run": True,
+        }
+
+    usuarios_registrados = 0
+    try:
+        for i, usuario in validos:
+            try:
+                error = guardar_usuario_importado(usuario)
+            except Exception as e:
+                error = f"Error inesperado: {str(e)}"
+
+            if error:
+                resultados[i] = {"usuario": usuario.documento_identidad, "status": estado_error, "mensaje": error}
+            else:
+                resultados[i] = {"usuario": usuario.documento_identidad, "status": estado_exito, "mensaje": "Usuario registrado correctamente."}
+                usuarios_registrados += 1
+    finally:
+        # una sola escritura de version por importacion
+        if usuarios_registrados:
+            incrementar_version_usuarios()
 
     # Resumen de la operación
     return {
-        "resultados": resultados,
+        "resultados": [resultados[i] for i in sorted(resultados)],
         "resumen": {
-            "total_procesados": usuarios_procesados,
+            "total_procesados": len(filas),
             "registrados_correctamente": usuarios_registrados,
-            "con_errores": usuarios_con_error
-        }
+            "con_errores": len(filas) - usuarios_registrados,
+        },
     }
 
+#endpoint para registrar varios usuarios a la vez
+@app.post("/usuarios/multiples", response_model=dict)
+async def registrar_usuarios_multiples(usuarios: List[Usuario], dry_run: bool = False):
+    filas = [usuario.model_dump() for usuario in usuarios]
+    return procesar_importacion(filas, dry_run, estado_exito="Éxito", estado_error="Error")
+
 #endpoint para registrar usuarios desde un archivo CSV
 @app.post("/usuarios/csv", response_model=dict)
-async def registrar_usuarios_csv(file: UploadFile):
+async def registrar_usuarios_csv(file: UploadFile, dry_run: bool = False):
     if file.content_type != "text/csv":
         raise HTTPException(status_code=400, detail="El archivo debe ser un CSV")
 
-    resultados = []
-    usuarios_procesados = 0
-    usuarios_registrados = 0
-    usuarios_con_error = 0
-    
     try:
         contenido = await file.read()
-        csv_data = StringIO(contenido.decode("utf-8"))
-        reader = csv.DictReader(csv_data)
-
-        for row in reader:
-            usuarios_procesados += 1
-            try:
-                # Verificar que todos los campos requeridos estén presentes
-                campos_requeridos = ["nombre", "email", "documento_identidad", "fecha_nacimiento"]
-                campos_faltantes = [campo for campo in campos_requeridos if campo not in row or not row[campo]]
-                
-                if campos_faltantes:
-                    resultados.append({
-                        "usuario": row.get("documento_identidad", "desconocido"), 
-                        "status": "error", 
-                        "mensaje": f"Faltan campos requeridos: {', '.join(campos_faltantes)}"
-                    })
-                    usuarios_con_error += 1
-                    continue
-                
-                # Validar documento de identidad
-                if not re.match(r"^[a-zA-Z0-9]{6,15}$", row["documento_identidad"]):
-                    resultados.append({
-                        "usuario": row["documento_identidad"], 
-                        "status": "error", 
-                        "mensaje": "El documento de identidad debe ser alfanumérico y tener entre 6 y 15 caracteres"
-                    })
-                    usuarios_con_error += 1
-                    continue
-                
-                # Crear usuario con o sin foto, dependiendo si existe en el CSV
-                usuario_params = {
-                    "nombre": row["nombre"],
-                    "email": row["email"],
-                    "documento_identidad": row["documento_identidad"],
-                    "fecha_nacimiento": row["fecha_nacimiento"]
-                }
-                
-                # Añadir foto si está presente en el CSV
-                if "foto" in row and row["foto"]:
-                    usuario_params["foto"] = row["foto"]
-                
-                # Intentar crear el objeto Usuario (esto validará el email y la fecha)
-                try:
-                    usuario = Usuario(**usuario_params)
-                except ValueError as ve:
-                    resultados.append({
-                        "usuario": row["documento_identidad"], 
-                        "status": "error", 
-                        "mensaje": f"Error de validación: {str(ve)}"
-                    })
-                    usuarios_con_error += 1
-                    continue
-                
-                # Convertir a mayúsculas el documento de identidad
-                usuario.documento_identidad = usuario.documento_identidad.upper()
-                usuario_ref = db.collection("usuarios").document(usuario.documento_identidad)
-
-                # Verificar si el usuario ya existe
-                if usuario_ref.get().exists:
-                    resultados.append({
-                        "usuario": usuario.documento_identidad, 
-                        "status": "error", 
-                        "mensaje": "El documento de identidad ya está registrado."
-                    })
-                    usuarios_con_error += 1
-                    continue
-
-                # Validar formato de email y convertir a minúsculas
-                usuario.email = usuario.email.lower()
-                
-                # Verificar si el email ya existe
-                email_ref = db.collection("usuarios").where("email", "==", usuario.email).get()
-                if email_ref:
-                    resultados.append({
-                        "usuario": usuario.documento_identidad, 
-                        "status": "error", 
-                        "mensaje": f"El email {usuario.email} ya está registrado con otro usuario."
-                    })
-                    usuarios_con_error += 1
-                    continue
-
-                # Preparar los datos del usuario
-                usuario_dict = usuario.model_dump()
-                usuario_dict["fecha_nacimiento"] = usuario.fecha_nacimiento.strftime("%Y-%m-%d")
-                usuario_dict["nombre_normalizado"] = normalizar_texto(usuario.nombre)
-                usuario_dict["nombre_minusculas"] = usuario.nombre.lower()
-                usuario_dict["email"] = usuario.email
-                usuario_dict["documento_identidad"] = usuario.documento_identidad
-
-                # Guardar en Firestore
-                usuario_ref.set(usuario_dict)
-                resultados.append({
-                    "usuario": usuario.documento_identidad, 
-                    "status": "éxito", 
-                    "mensaje": "Usuario registrado correctamente"
-                })
-                usuarios_registrados += 1
-                
-            except Exception as e:
-                resultados.append({
-                    "usuario": row.get("documento_identidad", "desconocido"), 
-                    "status": "error", 
-                    "mensaje": f"Error inesperado: {str(e)}"
-                })
-                usuarios_con_error += 1
-
+        filas = list(csv.DictReader(StringIO(contenido.decode("utf-8"))))
+        return procesar_importacion(filas, dry_run, estado_exito="éxito", estado_error="error")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al procesar el archivo CSV: {str(e)}")
 
-    # Resumen de la operación
-    return {
-        "resultados": resultados,
-        "resumen": {
-            "total_procesados": usuarios_procesados,
-            "registrados_correctamente": usuarios_registrados,
-            "con_errores": usuarios_con_error
-        }
-    }
-
 # mensaje de bienvenida en la raiz
 @app.get("/")
 def raiz():
@@ -0,0 +1,134 @@
+import os
+import sys
+import json
+import queue
+import atexit
+import random
+import logging
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+# nivel general de los logs (DEBUG, INFO, WARNING, ERROR)
+NIVEL_LOG = os.getenv("LOG_NIVEL", "INFO").upper()
+
+# niveles por ruta, por ejemplo "actualizar_usuario_parcial=DEBUG,subir_foto=WARNING"
+NIVELES_POR_RUTA = os.getenv("LOG_NIVELES_RUTAS", "")
+
+# fraccion de logs DEBUG/INFO que se guardan por ruta, por ejemplo "actualizar_usuario_parcial=0.1"
+MUESTREO_POR_RUTA = os.getenv("LOG_MUESTREO", "")
+
+# maximo de registros pendientes; si la cola se llena se descartan en lugar de bloquear la peticion
+MAX_REGISTROS_PENDIENTES = 10000
+
+# campos con datos personales que nunca se escriben en claro
+CAMPOS_PERSONALES = {"nombre", "nombre_normalizado", "nombre_minusculas", "email", "fecha_nacimiento", "foto"}
+
+# campos que se enmascaran dejando ver solo el principio y el final
+# (blob incluido: los nombres de las fotos antiguas llevan el documento de identidad)
+CAMPOS_IDENTIFICADORES = {"documento_identidad", "nuevo_documento_identidad", "documento", "blob"}
+
+
+# convertir "clave=valor,clave=valor" en un diccionario
+def parsear_pares(texto: str) -> dict:
+    pares = {}
+    for par in texto.split(","):
+        if "=" in par:
+            clave, valor = par.split("=", 1)
+            pares[clave.strip()] = valor.strip()
+    return pares
+
+
+# enmascarar un identificador dejando ver los dos primeros y el ultimo caracter
+def enmascarar(valor) -> str:
+    valor = str(valor)
+    if len(valor) <= 3:
+        return "***"
+    return f"{valor[:2]}{'*' * (len(valor) - 3)}{valor[-1]}"
+
+
+# quitar los datos personales de cualquier estructura antes de escribirla
+def redactar(datos):
+    if hasattr(datos, "model_dump"):
+        datos = datos.model_dump(exclude_unset=True)
+    if isinstance(datos, dict):
+        redactado = {}
+        for clave, valor in datos.items():
+            if clave in CAMPOS_PERSONALES:
+                redactado[clave] = "[redactado]" if valor is not None else None
+            elif clave in CAMPOS_IDENTIFICADORES and valor is not None:
+                redactado[clave] = enmascarar(valor)
+            else:
+                redactado[clave] = redactar(valor)
+        return redactado
+    if isinstance(datos, (list, tuple)):
+        return [redactar(valor) for valor in datos]
+    return datos
+
+
+# una linea JSON por registro, con los datos estructurados ya redactados
+class FormatoJSON(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entrada = {
+            "tiempo": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "nivel": record.levelname,
+            "logger": record.name,
+            "mensaje": record.getMessage(),
+        }
+        datos = getattr(record, "datos", None)
+        if datos is not None:
+            entrada["datos"] = redactar(datos)
+        if record.exc_info:
+            entrada["excepcion"] = self.formatException(record.exc_info)
+        return json.dumps(entrada, ensure_ascii=False, default=str)
+
+
+# deja pasar solo una fraccion de los DEBUG/INFO de cada ruta (los WARNING y ERROR siempre)
+class FiltroMuestreo(logging.Filter):
+    def __init__(self, tasas: dict):
+        super().__init__()
+        self.tasas = tasas
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        tasa = self.tasas.get(record.name.rsplit(".", 1)[-1], 1.0)
+        return tasa >= 1.0 or random.random() < tasa
+
+
+# encola el registro sin formatearlo: el JSON y la redaccion se hacen en el hilo del listener
+class ManejadorCola(QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass  # bajo mucha carga se pierde el registro en lugar de frenar la peticion
+
+
+_cola_registros = queue.Queue(maxsize=MAX_REGISTROS_PENDIENTES)
+
+_salida = logging.StreamHandler(sys.stdout)
+_salida.setFormatter(FormatoJSON())
+
+# el hilo del listener es el unico que escribe en stdout
+_listener = QueueListener(_cola_registros, _salida, respect_handler_level=True)
+_listener.start()
+atexit.register(_listener.stop)
+
+_manejador = ManejadorCola(_cola_registros)
+_manejador.addFilter(FiltroMuestreo({ruta: float(tasa) for ruta, tasa in parsear_pares(MUESTREO_POR_RUTA).items()}))
+
+logger_api = logging.getLogger("api")
+logger_api.setLevel(NIVEL_LOG)
+logger_api.addHandler(_manejador)
+logger_api.propagate = False
+
+for ruta, nivel in parsear_pares(NIVELES_POR_RUTA).items():
+    logging.getLogger(f"api.{ruta}").setLevel(nivel.upper())
+
+
+# logger de una ruta o componente (el nombre se usa para el nivel y el muestreo por ruta)
+def obtener_logger(nombre: str) -> logging.Logger:
+    return logging.getLogger(f"api.{nombre}")